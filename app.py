@@ -2,11 +2,21 @@ import os
 import streamlit as st
 from dotenv import load_dotenv
 import google.generativeai as genai
-# import easyocr  # Removed for simplicity - using pypdf text extraction instead
+from google import genai as genai_sdk  # Batch API lives in the newer google-genai SDK
+# import easyocr  # Removed for simplicity - using PyMuPDF text extraction instead
 import weaviate
-from pypdf import PdfReader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from weaviate.classes.query import Filter
+from weaviate.util import generate_uuid5
+import fitz  # PyMuPDF
+import tiktoken
 import tempfile
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import time
+import hashlib
+import sqlite3
+from contextlib import closing
 
 # Load environment variables
 load_dotenv()
@@ -15,15 +25,29 @@ load_dotenv()
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 model = genai.GenerativeModel('gemini-2.0-flash')
 
-# OCR initialization removed - using pypdf text extraction instead
+# Gemini Batch API client used for offline chunk categorization
+batch_client = genai_sdk.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+BATCH_POLL_INTERVAL = 30  # seconds between batch job status checks
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+# Local cache of chunk categories keyed by sha256 of the chunk text
+CATEGORY_CACHE_PATH = "categories.db"
+STORE_WINDOW = 100  # chunk ids per existence check / cache lookup, well under QUERY_MAXIMUM_RESULTS
+# sqlite3's context manager only commits, so closing() is what releases the connection
+with closing(sqlite3.connect(CATEGORY_CACHE_PATH)) as cache_db, cache_db:
+    cache_db.execute("CREATE TABLE IF NOT EXISTS chunk_categories (hash TEXT PRIMARY KEY, category TEXT)")
+
+# OCR initialization removed - using PyMuPDF text extraction instead
 
 # Initialize Weaviate client for local Docker instance using v4 API
+# Init checks stay enabled so an unreachable gRPC port fails here instead of on first insert
 client = weaviate.connect_to_local(
     host="localhost",
     port=8080,
-    grpc_port=50051,
-    skip_init_checks=True
+    grpc_port=50051
 )
+if not client.is_connected():
+    raise RuntimeError("Could not connect to Weaviate over gRPC on port 50051")
 
 # Create Weaviate schema if it doesn't exist
 
@@ -31,6 +55,14 @@ try:
     client.collections.create(
         name="Document",
         vectorizer_config=weaviate.classes.config.Configure.Vectorizer.text2vec_transformers(),
+        # HNSW graph parameters tuned for bulk ingestion (ef=-1 lets Weaviate pick ef per query).
+        # Binary quantization keeps ~1/32 of each float32 vector in memory, no training step
+        vector_index_config=weaviate.classes.config.Configure.VectorIndex.hnsw(
+            ef_construction=512,
+            max_connections=32,
+            ef=-1,
+            quantizer=weaviate.classes.config.Configure.VectorIndex.Quantizer.bq()
+        ),
         properties=[
             weaviate.classes.config.Property(name="content", data_type=weaviate.classes.config.DataType.TEXT),
             weaviate.classes.config.Property(name="category", data_type=weaviate.classes.config.DataType.TEXT),
@@ -43,34 +75,33 @@ except Exception as e:
         print(f"Schema creation error: {e}")
 
 def process_pdf(file):
-    # Create a temporary file to store the uploaded PDF
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-        temp_file.write(file.getvalue())
-        temp_path = temp_file.name
-
-    # Extract text from PDF
-    text = ""
-    pdf = PdfReader(temp_path)
-    
-    for page_num, page in enumerate(pdf.pages):
-        # For now, we'll extract text directly from PDF using pypdf
-        # Note: For proper OCR from PDF pages, you'd need to convert PDF to images first
-        page_text = page.extract_text()
-        if page_text:
-            text += page_text + " "
-    
-    # Clean up temporary file
-    os.unlink(temp_path)
+    # Extract text from PDF, parsing the uploaded bytes directly from memory
+    # Note: For proper OCR from PDF pages, you'd need to convert PDF to images first
+    with fitz.open(stream=file.getvalue(), filetype="pdf") as pdf:
+        parts = [page.get_text("text") for page in pdf]
+    text = " ".join(part for part in parts if part)
     
     return text
 
+# Tokenizer used for chunking; token counts roughly match the old 1000/200 character sizes
+encoding = tiktoken.get_encoding("cl100k_base")
+CHUNK_TOKENS = 250
+CHUNK_OVERLAP_TOKENS = 50
+
+def split_text(text, chunk_tokens=CHUNK_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """Split text into overlapping windows of a fixed number of tokens"""
+    ids = encoding.encode(text, disallowed_special=())
+    if not ids:
+        return []
+    step = chunk_tokens - overlap_tokens
+    return [
+        # Decode bytes leniently, a window edge can fall inside a multi-byte character
+        encoding.decode_bytes(ids[start:start + chunk_tokens]).decode("utf-8", errors="ignore")
+        for start in range(0, max(len(ids) - overlap_tokens, 1), step)
+    ]
+
 def chunk_text(text):
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len
-    )
-    chunks = text_splitter.split_text(text)
+    chunks = split_text(text)
     return chunks
 
 def categorize_chunks_batch(chunks):
@@ -79,12 +110,12 @@ def categorize_chunks_batch(chunks):
         return []
     
     # Create a batch prompt with all chunks
-    prompt = "Categorize each of the following text chunks into a single word category. Return only the categories, one per line, in the same order as the chunks:\n\n"
-    
-    for i, chunk in enumerate(chunks, 1):
-        prompt += f"Chunk {i}:\n{chunk[:500]}...\n\n"  # Limit chunk length to avoid token limits
-    
-    prompt += "Categories (one per line):"
+    prompt = (
+        "Categorize each of the following text chunks into a single word category. Return only the categories, one per line, in the same order as the chunks:\n\n"
+        # Limit chunk length to avoid token limits
+        + "".join(f"Chunk {i}:\n{chunk[:500]}...\n\n" for i, chunk in enumerate(chunks, 1))
+        + "Categories (one per line):"
+    )
     
     try:
         response = model.generate_content(prompt)
@@ -103,33 +134,261 @@ def categorize_chunks_batch(chunks):
         print(f"Error categorizing chunks: {e}")
         return ["document"] * len(chunks)  # Default fallback
 
-def store_in_weaviate(chunks):
-    # Batch categorize all chunks at once
-    categories = categorize_chunks_batch(chunks)
+def chunk_hash(chunk):
+    return hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+
+def get_cached_categories(hashes):
+    """Return {hash: category} for the hashes already in the category cache"""
+    if not hashes:
+        return {}
+    # A new connection per call keeps this safe from the backfill thread
+    hashes = list(hashes)
+    cached = {}
+    with closing(sqlite3.connect(CATEGORY_CACHE_PATH)) as cache_db:
+        # Look up in windows to stay under SQLite's bound-parameter limit
+        for start in range(0, len(hashes), STORE_WINDOW):
+            window = hashes[start:start + STORE_WINDOW]
+            placeholders = ",".join("?" * len(window))
+            rows = cache_db.execute(
+                f"SELECT hash, category FROM chunk_categories WHERE hash IN ({placeholders})",
+                window
+            ).fetchall()
+            cached.update(rows)
+    return cached
+
+def cache_categories(hashes, categories):
+    """Persist categories for later uploads, skipping chunks that got no category"""
+    rows = [(h, category) for h, category in zip(hashes, categories) if category]
+    with closing(sqlite3.connect(CATEGORY_CACHE_PATH)) as cache_db, cache_db:
+        cache_db.executemany("INSERT OR REPLACE INTO chunk_categories (hash, category) VALUES (?, ?)", rows)
+
+def categorize_prompt(chunk):
+    return f"Categorize the following text chunk into a single word category. Return only the category:\n\n{chunk[:500]}"
+
+def submit_categorization_batch(chunks):
+    """Submit one categorization request per chunk as a Gemini Batch job"""
+    with tempfile.NamedTemporaryFile("w", delete=False, suffix=".jsonl") as requests_file:
+        for i, chunk in enumerate(chunks):
+            request = {"contents": [{"parts": [{"text": categorize_prompt(chunk)}]}]}
+            requests_file.write(json.dumps({"key": f"chunk_{i}", "request": request}) + "\n")
+        requests_path = requests_file.name
+    
+    try:
+        uploaded = batch_client.files.upload(
+            file=requests_path,
+            config={"display_name": "chunk-categories", "mime_type": "jsonl"}
+        )
+    finally:
+        os.unlink(requests_path)
+    
+    return batch_client.batches.create(
+        model="gemini-2.0-flash",
+        src=uploaded.name,
+        config={"display_name": "chunk-categories"}
+    )
+
+def wait_for_categories(batch_job, num_chunks):
+    """Poll a categorization batch job and return its categories in chunk order (None where a request failed)"""
+    while batch_job.state.name not in BATCH_DONE_STATES:
+        time.sleep(BATCH_POLL_INTERVAL)
+        batch_job = batch_client.batches.get(name=batch_job.name)
+    
+    if batch_job.state.name != "JOB_STATE_SUCCEEDED":
+        raise RuntimeError(f"Batch job {batch_job.name} finished with state {batch_job.state.name}")
     
-    # Store all chunks with their categories using v4 API
+    categories = [None] * num_chunks
+    results = batch_client.files.download(file=batch_job.dest.file_name).decode("utf-8")
+    for line in results.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        index = int(result["key"].split("_", 1)[1])
+        try:
+            category = result["response"]["candidates"][0]["content"]["parts"][0]["text"].strip()
+        except (KeyError, IndexError):
+            continue  # Leave failed requests uncategorized
+        if category:
+            categories[index] = category
+    
+    return categories
+
+# Hashes with a backfill running in this process, shared across Streamlit reruns so a
+# re-upload doesn't submit a second batch job for the same chunks
+@st.cache_resource
+def get_backfill_state():
+    return set(), threading.Lock()
+
+backfill_in_flight, backfill_lock = get_backfill_state()
+
+def backfill_categories(chunks, hashes, uuids):
+    """Categorize stored chunks through the Batch API and update them in Weaviate"""
+    try:
+        try:
+            batch_job = submit_categorization_batch(chunks)
+            categories = wait_for_categories(batch_job, len(chunks))
+            cache_categories(hashes, categories)
+        except Exception as e:
+            print(f"Batch categorization failed, falling back to a single request: {e}")
+            categories = categorize_chunks_batch(chunks)
+        
+        update_categories(uuids, categories)
+    finally:
+        with backfill_lock:
+            backfill_in_flight.difference_update(hashes)
+
+def update_categories(uuids, categories):
     document_collection = client.collections.get("Document")
-    for chunk, category in zip(chunks, categories):
-        document_collection.data.insert({
-            "content": chunk,
-            "category": category
-        })
+    for object_uuid, category in zip(uuids, categories):
+        try:
+            document_collection.data.update(uuid=object_uuid, properties={"category": category or "document"})
+        except Exception as e:
+            print(f"Error updating category for {object_uuid}: {e}")
 
-def search_weaviate(query):
-    # Use Gemini to enhance the search query
-    prompt = f"Enhance this search query for better semantic search results: {query}"
-    enhanced_query = model.generate_content(prompt).text
+def store_in_weaviate(chunks):
+    # Key chunks by content hash so repeated chunks are stored and categorized only once
+    unique_chunks = {}
+    for chunk in chunks:
+        unique_chunks.setdefault(chunk_hash(chunk), chunk)
+    uuids = {h: generate_uuid5(h) for h in unique_chunks}
+    
+    # Skip chunks already stored (and vectorized) by a previous upload
+    document_collection = client.collections.get("Document")
+    all_uuids = list(uuids.values())
+    existing_categories = {}
+    for start in range(0, len(all_uuids), STORE_WINDOW):
+        window = all_uuids[start:start + STORE_WINDOW]
+        existing = document_collection.query.fetch_objects(
+            filters=Filter.by_id().contains_any(window),
+            limit=len(window),
+            return_properties=["category"]
+        )
+        existing_categories.update((str(obj.uuid), obj.properties.get("category")) for obj in existing.objects)
+    new_hashes = [h for h in unique_chunks if str(uuids[h]) not in existing_categories]
+    
+    # Stored chunks still without a category lost their backfill (e.g. the app restarted
+    # while the batch job ran) unless one is running now; categorize them again
+    with backfill_lock:
+        uncategorized = [
+            h for h in unique_chunks
+            if str(uuids[h]) in existing_categories and existing_categories[str(uuids[h])] is None
+            and h not in backfill_in_flight
+        ]
+    if not new_hashes and not uncategorized:
+        return
+    
+    # Chunks without a cached category are stored right away and backfilled once the batch job finishes
+    cached = get_cached_categories(new_hashes + uncategorized)
+    recovered = [h for h in uncategorized if h in cached]
+    if recovered:
+        update_categories([uuids[h] for h in recovered], [cached[h] for h in recovered])
+    
+    # Store all new chunks in a single batch using v4 API
+    with document_collection.batch.dynamic() as batch:
+        for h in new_hashes:
+            batch.add_object(
+                properties={
+                    "content": unique_chunks[h],
+                    "category": cached.get(h)
+                },
+                uuid=uuids[h]
+            )
     
+    failed = document_collection.batch.failed_objects
+    if failed:
+        print(f"Warning: {len(failed)} of {len(new_hashes)} chunks failed to store. First error: {failed[0].message}")
+    
+    # Categorization is not latency-critical, so run it off the request path
+    with backfill_lock:
+        uncached = [h for h in new_hashes + uncategorized if h not in cached and h not in backfill_in_flight]
+        backfill_in_flight.update(uncached)
+    if uncached:
+        threading.Thread(
+            target=backfill_categories,
+            args=([unique_chunks[h] for h in uncached], uncached, [uuids[h] for h in uncached]),
+            daemon=True
+        ).start()
+
+# Seconds to wait for the Gemini query enhancement before using the plain-query ranking
+ENHANCE_TIMEOUT = 3.0
+# Enhancement calls allowed in flight at once, so slow Gemini calls can't fill the pool
+MAX_PENDING_ENHANCEMENTS = 2
+# Plain-query BM25 candidates fetched for re-ranking, and results shown
+SEARCH_CANDIDATES = 10
+SEARCH_RESULTS = 3
+
+# Streamlit re-runs this script on every interaction; cache_resource keeps one pool and one
+# set of enhancement slots for the whole process instead of a new pair per rerun
+@st.cache_resource
+def get_search_executor():
+    return ThreadPoolExecutor(max_workers=MAX_PENDING_ENHANCEMENTS + 2)
+
+@st.cache_resource
+def get_enhance_slots():
+    return threading.BoundedSemaphore(MAX_PENDING_ENHANCEMENTS)
+
+search_executor = get_search_executor()
+enhance_slots = get_enhance_slots()
+
+def bm25_search(query, limit=SEARCH_RESULTS, filters=None):
     # Search Weaviate using v4 API
     document_collection = client.collections.get("Document")
     response = document_collection.query.bm25(
-        query=enhanced_query,
+        query=query,
         query_properties=["content", "category"],
-        limit=3
+        filters=filters,
+        limit=limit
     )
-    
     return response.objects
 
+def enhance_query(prompt):
+    """Ask Gemini for an enhanced query; releases its enhancement slot when done"""
+    try:
+        # The request timeout ends the call (and frees the worker) soon after we stop waiting
+        return model.generate_content(prompt, request_options={"timeout": ENHANCE_TIMEOUT}).text
+    finally:
+        enhance_slots.release()
+
+def rerank(results, enhanced_query):
+    """Re-score the plain-query candidates with BM25 on the enhanced query.
+    
+    Candidates the enhanced query doesn't match keep their plain BM25 order after the rest.
+    """
+    if not results:
+        return results
+    reranked = bm25_search(
+        enhanced_query,
+        SEARCH_RESULTS,
+        filters=Filter.by_id().contains_any([result.uuid for result in results])
+    )
+    reranked_uuids = {result.uuid for result in reranked}
+    return (reranked + [result for result in results if result.uuid not in reranked_uuids])[:SEARCH_RESULTS]
+
+def search_weaviate(query):
+    # Search with the plain query while Gemini enhances it, then re-rank its candidates
+    plain_future = search_executor.submit(bm25_search, query, SEARCH_CANDIDATES)
+    
+    if not enhance_slots.acquire(blocking=False):
+        print("Too many pending query enhancements, using plain query results")
+        return plain_future.result()[:SEARCH_RESULTS]
+    
+    prompt = (
+        "Rewrite this search query with the keywords a matching document would contain. "
+        f"Return only the rewritten query on one line, without any explanation: {query}"
+    )
+    try:
+        enhance_future = search_executor.submit(enhance_query, prompt)
+    except Exception:
+        enhance_slots.release()
+        raise
+    
+    try:
+        enhanced_query = enhance_future.result(timeout=ENHANCE_TIMEOUT).strip()
+    except Exception as e:
+        print(f"Query enhancement unavailable, using plain query results: {e!r}")
+        return plain_future.result()[:SEARCH_RESULTS]
+    
+    return rerank(plain_future.result(), enhanced_query)
+
 # Streamlit UI
 st.title("PDF Document Search Engine")
 
@@ -147,7 +406,7 @@ if uploaded_file is not None:
             # Store in Weaviate
             store_in_weaviate(chunks)
             
-            st.success("PDF processed and stored successfully!")
+            st.success("PDF processed and stored successfully! Categories will appear once batch categorization completes.")
 
 # Search interface
 search_query = st.text_input("Enter your search query")
@@ -158,5 +417,5 @@ if search_query:
             
             for result in results:
                 st.write("---")
-                st.write("**Category:**", result.properties.get("category", "Unknown"))
+                st.write("**Category:**", result.properties.get("category") or "Pending")
                 st.write("**Content:**", result.properties.get("content", "No content"))
@@ -4,24 +4,45 @@ PDF Policy Query System - Weaviate v4 Compatible
 
 import os
 import re
+import asyncio
+import hashlib
+import shutil
 import tempfile
+import time
+import random
 import logging
-from typing import List, Dict, Optional
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import BinaryIO, List, Dict, Iterable, Iterator, Optional
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+import numpy as np
+
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import google.generativeai as genai
 import weaviate
 import weaviate.classes as wvc
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from pypdf import PdfReader
+from weaviate.collections.classes.config import BQConfig
+from weaviate.util import generate_uuid5
+import tiktoken
+import fitz  # PyMuPDF
+
+import pdf_worker
+from gemini_schema import ANSWER_GENERATION_CONFIG, GeminiAnswer
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Text cleanup patterns, compiled once at import
+PAGE_NUMBER_RE = re.compile(r'\bpage\s*\d+\b', re.IGNORECASE)
+LIST_MARKER_RE = re.compile(r'^\s*(?:[-*•]|\d+[.)])\s*')
+
 # Load environment variables
 load_dotenv()
 
@@ -29,50 +50,89 @@ load_dotenv()
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 model = genai.GenerativeModel('gemini-2.0-flash')
 
-# Initialize Weaviate client (v4 API)
-client = None
-try:
-    client = weaviate.connect_to_local(
-        host="localhost",
-        port=8080,
-        grpc_port=50051
+# PolicyDocument schema, shared by startup and the clear-documents endpoint
+HNSW_EF_CONSTRUCTION = 512
+HNSW_MAX_CONNECTIONS = 32
+CONTENT_HASH_PROPERTY = wvc.config.Property(
+    name="content_hash",
+    data_type=wvc.config.DataType.TEXT,
+    tokenization=wvc.config.Tokenization.FIELD,
+    skip_vectorization=True
+)
+POLICY_COLLECTION_CONFIG = dict(
+    name="PolicyDocument",
+    vectorizer_config=wvc.config.Configure.Vectorizer.none(),  # Vectors are computed with Gemini
+    # HNSW graph parameters tuned for bulk ingestion (ef=-1 lets Weaviate pick ef per query).
+    # Binary quantization keeps ~1/32 of each float32 vector in memory, no training step
+    vector_index_config=wvc.config.Configure.VectorIndex.hnsw(
+        ef_construction=HNSW_EF_CONSTRUCTION,
+        max_connections=HNSW_MAX_CONNECTIONS,
+        ef=-1,
+        quantizer=wvc.config.Configure.VectorIndex.Quantizer.bq()
+    ),
+    properties=[
+        wvc.config.Property(name="content", data_type=wvc.config.DataType.TEXT),
+        wvc.config.Property(name="source", data_type=wvc.config.DataType.TEXT),
+        # sha256 of the content, to reuse vectors of text repeated across documents
+        CONTENT_HASH_PROPERTY
+    ]
+)
+
+def policy_schema_is_current(client) -> bool:
+    """Check that the stored PolicyDocument matches POLICY_COLLECTION_CONFIG.
+    
+    Collections created by older versions use text2vec-transformers (384-dim MiniLM
+    vectors) without BQ or HNSW tuning, and reject the 768-dim Gemini vectors.
+    """
+    config = client.collections.get("PolicyDocument").config.get()
+    index = config.vector_index_config
+    return (
+        config.vectorizer == wvc.config.Vectorizers.NONE
+        and index is not None
+        and getattr(index, "ef_construction", None) == HNSW_EF_CONSTRUCTION
+        and getattr(index, "max_connections", None) == HNSW_MAX_CONNECTIONS
+        and isinstance(getattr(index, "quantizer", None), BQConfig)
     )
-    logger.info("✅ Connected to Weaviate v4")
+
+def connect_weaviate():
+    """Connect to Weaviate (v4 API, gRPC for queries and batch inserts) and set up the schema"""
+    try:
+        client = weaviate.connect_to_local(
+            host="localhost",
+            port=8080,
+            grpc_port=50051
+        )
+        logger.info("✅ Connected to Weaviate v4")
+    except Exception as e:
+        # No REST-only fallback: batch ingestion depends on the gRPC API
+        logger.error(f"❌ Weaviate connection failed (gRPC port 50051 must be reachable): {e}")
+        return None
     
-    # Setup schema immediately
+    # Setup schema immediately, keeping documents stored by previous runs
     try:
-        # Delete existing collection if it exists
-        try:
+        if client.collections.exists("PolicyDocument") and not policy_schema_is_current(client):
+            logger.warning(
+                "⚠️ PolicyDocument was created with an outdated schema (vectorizer or vector index "
+                "differs). Recreating it: previously stored documents are removed and must be re-uploaded."
+            )
             client.collections.delete("PolicyDocument")
-        except:
-            pass
         
-        # Create collection with v4 API
-        client.collections.create(
-            name="PolicyDocument",
-            vectorizer_config=wvc.config.Configure.Vectorizer.text2vec_transformers(),
-            properties=[
-                wvc.config.Property(name="content", data_type=wvc.config.DataType.TEXT),
-                wvc.config.Property(name="source", data_type=wvc.config.DataType.TEXT)
-            ]
-        )
-        logger.info("✅ Schema created with v4 API")
+        if client.collections.exists("PolicyDocument"):
+            collection = client.collections.get("PolicyDocument")
+            if all(prop.name != "content_hash" for prop in collection.config.get().properties):
+                collection.config.add_property(CONTENT_HASH_PROPERTY)
+            logger.info("✅ Schema already exists")
+        else:
+            client.collections.create(**POLICY_COLLECTION_CONFIG)
+            logger.info("✅ Schema created with v4 API")
     except Exception as e:
         logger.error(f"Schema error: {e}")
+    
+    return client
 
-except Exception as e:
-    logger.error(f"❌ Weaviate connection failed: {e}")
-    # Fallback to REST-only connection
-    try:
-        client = weaviate.connect_to_local(
-            host="localhost", 
-            port=8080,
-            skip_init_checks=True
-        )
-        logger.info("✅ Connected to Weaviate (REST-only)")
-    except Exception as e2:
-        logger.error(f"❌ Fallback connection also failed: {e2}")
-        client = None
+# Page worker processes re-run this file as __mp_main__ when started with
+# `python backend.py`; they must not open their own Weaviate connection
+client = connect_weaviate() if __name__ != "__mp_main__" else None
 
 # FastAPI App
 app = FastAPI(title="PDF Policy Query System")
@@ -95,15 +155,110 @@ class QueryResponse(BaseModel):
     sources: Optional[List[str]] = None
     cross_document_analysis: Optional[str] = None
 
+class SemanticCache:
+    """In-memory cache of query responses keyed by query embedding.
+    
+    A lookup hits when the most similar cached query has a cosine similarity of at
+    least `threshold`. Entries expire after `ttl` seconds, and the least recently
+    used entry is evicted once `max_entries` is reached. `clear()` bumps the cache
+    generation so that responses computed before it are dropped instead of stored.
+    """
+    
+    def __init__(self, threshold: float = 0.92, max_entries: int = 1000, ttl: float = 3600):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()  # id -> (unit vector, response, stored_at)
+        self._next_id = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+    
+    @property
+    def generation(self) -> int:
+        return self._generation
+    
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+    
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        expired = [key for key, (_, _, stored_at) in self._entries.items() if stored_at < cutoff]
+        for key in expired:
+            del self._entries[key]
+    
+    def lookup(self, embedding: List[float]) -> Optional["QueryResponse"]:
+        """Return the cached response for the closest query, or None on a miss"""
+        vector = self._normalize(embedding)
+        with self._lock:
+            self._expire()
+            if not self._entries:
+                return None
+            
+            keys = list(self._entries)
+            scores = np.stack([self._entries[key][0] for key in keys]) @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            
+            self._entries.move_to_end(keys[best])
+            return self._entries[keys[best]][1]
+    
+    def store(self, embedding: List[float], response: "QueryResponse", generation: Optional[int] = None):
+        vector = self._normalize(embedding)
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[self._next_id] = (vector, response, time.time())
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+query_cache = SemanticCache()
+
+# Gemini embedding model for queries and document chunks
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+def embed_query(query: str, request_options: Optional[dict] = None) -> List[float]:
+    """Embed a user query for semantic cache lookups"""
+    result = genai.embed_content(
+        model=EMBEDDING_MODEL,
+        content=query,
+        task_type="retrieval_query",
+        request_options=request_options
+    )
+    return result["embedding"]
+
+def embed_documents(texts: List[str], request_options: Optional[dict] = None) -> List[List[float]]:
+    """Embed up to 100 document chunks in a single batchEmbedContents request"""
+    result = genai.embed_content(
+        model=EMBEDDING_MODEL,
+        content=texts,
+        task_type="retrieval_document",
+        request_options=request_options
+    )
+    return result["embedding"]
+
 class DocumentInfo(BaseModel):
     filename: str
     chunks_created: int
     text_length: int
 
+class FailedDocument(BaseModel):
+    filename: str
+    error: str
+
 class MultiUploadResponse(BaseModel):
     message: str
     documents: List[DocumentInfo]
     total_documents: int
+    failed_documents: List[FailedDocument] = []
 
 @app.get("/")
 async def root():
@@ -129,76 +284,277 @@ async def test_upload(files: List[UploadFile] = File(...)):
         })
     return {"received_files": result}
 
-async def process_single_pdf(file: UploadFile) -> DocumentInfo:
-    """Process a single PDF file"""
-    if not file.filename.endswith('.pdf'):
-        raise HTTPException(status_code=400, detail=f"Only PDF files supported: {file.filename}")
-    
-    logger.info(f"📄 Processing {file.filename}")
-    
-    # Read file
-    content = await file.read()
+# Page count from which text extraction is spread across worker processes. Inline extraction
+# runs at a few ms per page, while each new worker pays about a second re-importing this
+# module, so only very long documents gain from the pool.
+PARALLEL_PAGE_THRESHOLD = 500
+
+# Shared pool for page extraction, bounded by the CPU count across all uploads. Workers come
+# from a forkserver that only preloads pdf_worker (or are spawned where forkserver is not
+# available, e.g. Windows), never forked from this process, which holds live gRPC channels
+# and busy threads.
+_page_pool: Optional[ProcessPoolExecutor] = None
+_page_pool_lock = threading.Lock()
+
+def get_page_pool() -> ProcessPoolExecutor:
+    global _page_pool
+    with _page_pool_lock:
+        if _page_pool is None:
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                mp_context = multiprocessing.get_context("forkserver")
+                mp_context.set_forkserver_preload(["pdf_worker"])
+            else:
+                mp_context = multiprocessing.get_context("spawn")
+            _page_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=mp_context)
+        return _page_pool
+
+def _reset_page_pool(broken: ProcessPoolExecutor):
+    """Drop a pool whose workers died so the next upload starts a fresh one"""
+    global _page_pool
+    with _page_pool_lock:
+        if _page_pool is broken:
+            _page_pool = None
+    broken.shutdown(wait=False)
+
+def iter_page_texts(pdf_path: str) -> Iterator[str]:
+    """Yield the text of each page of a PDF, in parallel for large documents.
     
-    # Extract text from PDF
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-        temp_file.write(content)
-        temp_path = temp_file.name
+    PyMuPDF is not thread-safe, so each worker process opens its own copy of the
+    document and handles a contiguous range of pages.
+    """
+    with fitz.open(pdf_path) as pdf:
+        page_count = pdf.page_count
+        workers = min(os.cpu_count() or 1, page_count)
+        if page_count < PARALLEL_PAGE_THRESHOLD or workers < 2:
+            for page in pdf:
+                yield page.get_text("text")
+            return
     
-    text = ""
+    step = -(-page_count // workers)  # ceil division
+    starts = list(range(0, page_count, step))
+    stops = [min(start + step, page_count) for start in starts]
+    pool = get_page_pool()
     try:
-        pdf = PdfReader(temp_path)
-        for page in pdf.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text += page_text + " "
-    finally:
-        os.unlink(temp_path)
+        for page_range in pool.map(pdf_worker.extract_page_range, [pdf_path] * len(starts), starts, stops):
+            yield from page_range
+    except BrokenProcessPool:
+        _reset_page_pool(pool)
+        raise
+
+def clean_text(text: str) -> str:
+    """Collapse whitespace (str.split/join avoids the regex engine) and drop page numbers"""
+    return PAGE_NUMBER_RE.sub('', " ".join(text.split()))
+
+# Tokenizer used for chunking; 128 tokens is about the old 500 character chunk size
+encoding = tiktoken.get_encoding("cl100k_base")
+CHUNK_TOKENS = 128
+CHUNK_OVERLAP_TOKENS = 12
+
+def _decode_tokens(ids: List[int]) -> str:
+    # Decode bytes leniently, a window edge can fall inside a multi-byte character
+    return encoding.decode_bytes(ids).decode("utf-8", errors="ignore")
+
+def iter_chunks(texts: Iterable[str], chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> Iterator[str]:
+    """Yield overlapping windows of a fixed number of tokens from a stream of texts.
     
-    if not text.strip():
-        raise HTTPException(status_code=400, detail=f"No text found in PDF: {file.filename}")
+    Only a buffer of about one chunk of token ids is held at a time, so the full
+    document text is never materialized.
+    """
+    step = chunk_tokens - overlap_tokens
+    buffer: List[int] = []
+    emitted = False
+    for text in texts:
+        if not text:
+            continue
+        buffer.extend(encoding.encode(text + " ", disallowed_special=()))
+        while len(buffer) >= chunk_tokens:
+            yield _decode_tokens(buffer[:chunk_tokens])
+            emitted = True
+            del buffer[:step]
     
-    # Clean text
-    text = re.sub(r'\s+', ' ', text.strip())
-    text = re.sub(r'\bpage\s*\d+\b', '', text, flags=re.IGNORECASE)
+    # The tail is only new text if it extends past the previous chunk's overlap
+    if len(buffer) > overlap_tokens or (buffer and not emitted):
+        yield _decode_tokens(buffer)
+
+# Chunks collected per existence check and embedding request before they are added
+# to the insert batch (100 is also the batchEmbedContents limit)
+STORE_WINDOW = 100
+
+# Objects fetched when looking for stored vectors of a window's chunks; text repeated across
+# many documents returns one object per document, so a hash may go unmatched and be re-embedded
+VECTOR_REUSE_LIMIT = 1000
+
+def _stored_vectors(collection, chunk_hashes: List[str]) -> Dict[str, List[float]]:
+    """Return {content hash: vector} for chunks already stored with a vector under any source"""
+    existing = collection.query.fetch_objects(
+        filters=wvc.query.Filter.by_property("content_hash").contains_any(chunk_hashes),
+        limit=VECTOR_REUSE_LIMIT,
+        include_vector=True,
+        return_properties=["content_hash"]
+    )
+    vectors = {}
+    for obj in existing.objects:
+        vector = obj.vector.get("default") if obj.vector else None
+        if vector:
+            vectors.setdefault(obj.properties["content_hash"], vector)
+    return vectors
+
+def _add_new_chunks(collection, batch, window: List[tuple], source: str) -> int:
+    """Embed the chunks in `window` that aren't stored in Weaviate yet and add them to the batch.
     
-    # Create chunks
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=500,
-        chunk_overlap=50,
-        length_function=len
+    Text already stored for another document (headers, boilerplate clauses) reuses that
+    object's vector. Chunks whose embedding request fails are still added, without a
+    vector: search is BM25 over the stored text, so they stay findable. Returns how many
+    were added that way.
+    """
+    existing = collection.query.fetch_objects(
+        filters=wvc.query.Filter.by_id().contains_any([object_uuid for _, _, object_uuid in window]),
+        limit=len(window)
     )
-    chunks = splitter.split_text(text)
-    chunks = [chunk.strip() for chunk in chunks if len(chunk.strip()) > 30]
+    existing_uuids = {str(obj.uuid) for obj in existing.objects}
+    new_chunks = [entry for entry in window if str(entry[2]) not in existing_uuids]
+    if not new_chunks:
+        return 0
     
-    if not chunks:
-        raise HTTPException(status_code=400, detail=f"Could not create chunks for: {file.filename}")
+    vectors = _stored_vectors(collection, [chunk_hash for _, chunk_hash, _ in new_chunks])
+    to_embed = [(chunk, chunk_hash) for chunk, chunk_hash, _ in new_chunks if chunk_hash not in vectors]
+    if to_embed:
+        try:
+            embedded = embed_documents([chunk for chunk, _ in to_embed])
+            if len(embedded) != len(to_embed):
+                raise ValueError(f"got {len(embedded)} vectors for {len(to_embed)} chunks")
+            vectors.update(zip((chunk_hash for _, chunk_hash in to_embed), embedded))
+        except Exception as e:
+            logger.error(f"Embedding error for {len(to_embed)} chunks from {source}, storing them without vectors: {e}")
+    
+    for chunk, chunk_hash, object_uuid in new_chunks:
+        batch.add_object(
+            properties={
+                "content": chunk,
+                "source": source,
+                "content_hash": chunk_hash
+            },
+            uuid=object_uuid,
+            vector=vectors.get(chunk_hash)
+        )
+    return sum(chunk_hash not in vectors for _, chunk_hash, _ in new_chunks)
+
+def _store_pdf(pdf_path: str, filename: str) -> tuple:
+    """Extract, chunk and store a PDF; returns its DocumentInfo and sampled chunks"""
+    text_length = 0
     
-    # Store in Weaviate using v4 API
+    def cleaned_pages() -> Iterator[str]:
+        nonlocal text_length
+        for page_text in iter_page_texts(pdf_path):
+            page_text = clean_text(page_text)
+            text_length += len(page_text)
+            yield page_text
+    
+    # Stream pages -> cleaned text -> chunks -> batched inserts, holding only a window of chunks.
+    # Chunks are keyed by content hash and source so repeated chunks (within this file or
+    # from re-uploading it) map to one object; text shared with other files reuses their vector.
     collection = client.collections.get("PolicyDocument")
-    stored = 0
+    seen = set()
+    window = []
+    samples = []  # Reservoir sample of chunks for query cache warmup
+    unembedded = 0
     
-    for chunk in chunks:
-        try:
-            collection.data.insert({
-                "content": chunk,
-                "source": file.filename
-            })
-            stored += 1
-        except Exception as e:
-            logger.error(f"Storage error for chunk: {e}")
+    # Store new chunks in Weaviate using v4 batch API (one request per batch instead of per chunk)
+    with collection.batch.dynamic() as batch:
+        for chunk in iter_chunks(cleaned_pages()):
+            chunk = chunk.strip()
+            if len(chunk) <= 30:
+                continue
+            chunk_hash = hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+            if chunk_hash in seen:
+                continue
+            seen.add(chunk_hash)
+            
+            if len(samples) < WARM_CACHE_SAMPLE_CHUNKS:
+                samples.append(chunk)
+            else:
+                slot = random.randrange(len(seen))
+                if slot < WARM_CACHE_SAMPLE_CHUNKS:
+                    samples[slot] = chunk
+            
+            window.append((chunk, chunk_hash, generate_uuid5(chunk_hash, filename)))
+            if len(window) >= STORE_WINDOW:
+                unembedded += _add_new_chunks(collection, batch, window, filename)
+                window = []
+        
+        if window:
+            unembedded += _add_new_chunks(collection, batch, window, filename)
+    
+    if text_length == 0:
+        raise HTTPException(status_code=400, detail=f"No text found in PDF: {filename}")
+    
+    if not seen:
+        raise HTTPException(status_code=400, detail=f"Could not create chunks for: {filename}")
+    
+    failed = collection.batch.failed_objects
+    for failed_obj in failed:
+        logger.error(f"Storage error for chunk: {failed_obj.message}")
+    stored = len(seen) - len(failed)
+    if unembedded:
+        logger.warning(f"⚠️ {unembedded} chunks from {filename} were stored without vectors")
     
     if stored == 0:
-        raise HTTPException(status_code=500, detail=f"Failed to store any chunks for: {file.filename}")
+        raise HTTPException(status_code=500, detail=f"Failed to store any chunks for: {filename}")
+    
+    # Cached answers may no longer reflect the document set
+    query_cache.clear()
     
-    logger.info(f"✅ Stored {stored} chunks from {file.filename}")
-    return DocumentInfo(
-        filename=file.filename,
+    logger.info(f"✅ Stored {stored} chunks from {filename}")
+    doc_info = DocumentInfo(
+        filename=filename,
         chunks_created=stored,
-        text_length=len(text)
+        text_length=text_length
     )
+    return doc_info, samples
+
+# Bytes copied at a time when moving an upload to disk
+UPLOAD_COPY_CHUNK = 1 << 20
+
+def _parse_and_store(upload: BinaryIO, filename: str) -> tuple:
+    """Copy an upload to a temp file and store it; returns its DocumentInfo and sampled chunks.
+    
+    The upload is copied in chunks rather than read into memory, and MuPDF (and the
+    page worker processes) load pages from the file on demand, so the PDF is never
+    held in memory as a whole. This is blocking CPU and network work, so callers run
+    it in a worker thread.
+    """
+    upload.seek(0)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
+        pdf_path = temp_file.name
+    
+    try:
+        with open(pdf_path, "wb") as pdf_file:
+            shutil.copyfileobj(upload, pdf_file, UPLOAD_COPY_CHUNK)
+        return _store_pdf(pdf_path, filename)
+    finally:
+        os.unlink(pdf_path)
+
+def validate_pdf_filename(file: UploadFile):
+    if not file.filename.endswith('.pdf'):
+        raise HTTPException(status_code=400, detail=f"Only PDF files supported: {file.filename}")
+
+async def process_single_pdf(file: UploadFile, background_tasks: Optional[BackgroundTasks] = None) -> DocumentInfo:
+    """Process a single PDF file"""
+    validate_pdf_filename(file)
+    
+    logger.info(f"📄 Processing {file.filename}")
+    
+    # Parse and store off the event loop so other requests keep being served
+    doc_info, samples = await asyncio.to_thread(_parse_and_store, file.file, file.filename)
+    
+    # Re-warm the query cache once the response is sent
+    if background_tasks is not None:
+        background_tasks.add_task(warm_query_cache, samples, file.filename)
+    
+    return doc_info
 
 @app.post("/upload")
-async def upload_documents(files: List[UploadFile] = File(...)):
+async def upload_documents(background_tasks: BackgroundTasks, files: List[UploadFile] = File(...)):
     """Upload and process up to 3 PDFs"""
     if not client:
         raise HTTPException(status_code=500, detail="Database not available")
@@ -213,15 +569,39 @@ async def upload_documents(files: List[UploadFile] = File(...)):
     if len(files) == 0:
         raise HTTPException(status_code=400, detail="At least 1 PDF file required")
     
+    # Reject the whole request before any file is stored
+    for file in files:
+        validate_pdf_filename(file)
+    
     try:
-        processed_docs = []
+        # Process files concurrently; each one is parsed and stored in its own thread
+        results = await asyncio.gather(
+            *(process_single_pdf(file, background_tasks) for file in files),
+            return_exceptions=True
+        )
+        
+        processed_docs = [result for result in results if isinstance(result, DocumentInfo)]
+        failed_docs = []
+        for file, result in zip(files, results):
+            if isinstance(result, BaseException):
+                error = result.detail if isinstance(result, HTTPException) else str(result)
+                logger.error(f"Upload error for {file.filename}: {error}")
+                failed_docs.append({"filename": file.filename, "error": error})
         
-        for file in files:
-            doc_info = await process_single_pdf(file)
-            processed_docs.append(doc_info)
+        # Nothing was stored: surface the first failure as before
+        if not processed_docs:
+            first_error = next(result for result in results if isinstance(result, BaseException))
+            raise first_error
+        
+        message = f"Successfully processed {len(processed_docs)} document(s)"
+        if failed_docs:
+            message = (
+                f"Processed {len(processed_docs)} of {len(files)} document(s); failed: "
+                + ", ".join(f"{doc['filename']} ({doc['error']})" for doc in failed_docs)
+            )
         
         return {
-            "message": f"Successfully processed {len(processed_docs)} document(s)",
+            "message": message,
             "documents": [
                 {
                     "filename": doc.filename,
@@ -229,7 +609,8 @@ async def upload_documents(files: List[UploadFile] = File(...)):
                     "text_length": doc.text_length
                 } for doc in processed_docs
             ],
-            "total_documents": len(processed_docs)
+            "total_documents": len(processed_docs),
+            "failed_documents": failed_docs
         }
         
     except HTTPException:
@@ -239,13 +620,13 @@ async def upload_documents(files: List[UploadFile] = File(...)):
         raise HTTPException(status_code=500, detail=f"Processing error: {str(e)}")
 
 @app.post("/upload-single")
-async def upload_single_document(file: UploadFile = File(...)):
+async def upload_single_document(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
     """Upload and process a single PDF (for backward compatibility)"""
     if not client:
         raise HTTPException(status_code=500, detail="Database not available")
     
     try:
-        doc_info = await process_single_pdf(file)
+        doc_info = await process_single_pdf(file, background_tasks)
         return {
             "message": f"Successfully processed {doc_info.filename}",
             "chunks_created": doc_info.chunks_created,
@@ -257,147 +638,165 @@ async def upload_single_document(file: UploadFile = File(...)):
         logger.error(f"Upload error: {e}")
         raise HTTPException(status_code=500, detail=f"Processing error: {str(e)}")
 
-@app.post("/query", response_model=QueryResponse)
-async def query_documents(request: QueryRequest):
-    """Query documents with cross-document analysis"""
-    if not client:
-        raise HTTPException(status_code=500, detail="Database not available")
+# Seconds to wait for the query embedding before answering without the semantic cache
+CACHE_EMBED_TIMEOUT = 2.0
+
+def search_documents(query: str) -> list:
+    """BM25 search over stored chunks"""
+    collection = client.collections.get("PolicyDocument")
+    response = collection.query.bm25(
+        query=query,
+        limit=5,  # Get more results for cross-document analysis
+        return_properties=["content", "source"]
+    )
+    return response.objects
+
+async def answer_query(query: str, cache_generation: Optional[int] = None) -> QueryResponse:
+    """Run the query pipeline: semantic cache, Weaviate search, then Gemini analysis"""
+    logger.info(f"🔍 Query: {query}")
+    if cache_generation is None:
+        cache_generation = query_cache.generation
     
-    try:
-        logger.info(f"🔍 Query: {request.query}")
-        
-        # Search Weaviate using v4 API - get more results for cross-document analysis
-        try:
-            collection = client.collections.get("PolicyDocument")
-            response = collection.query.bm25(
-                query=request.query,
-                limit=5,  # Get more results for cross-document analysis
-                return_properties=["content", "source"]
-            )
-            
-            documents = response.objects
-            
-        except Exception as e:
-            logger.error(f"Search error: {e}")
-            documents = []
-        
-        if not documents:
-            return QueryResponse(
-                answer="No relevant information found",
-                explanation="I couldn't find any information in your uploaded documents that relates to your question. Please make sure you've uploaded PDF documents and try again.",
-                sources=None
-            )
-        
-        # Group documents by source for cross-document analysis
-        source_content = {}
-        for doc in documents:
-            content = doc.properties.get("content", "")
-            source = doc.properties.get("source", "unknown")
-            if source not in source_content:
-                source_content[source] = []
-            source_content[source].append(content)
-        
-        # Prepare content for analysis
-        all_sources = list(source_content.keys())
-        combined_content = []
-        
-        for source, contents in source_content.items():
-            # Take the most relevant chunk from each document
-            best_content = contents[0] if contents else ""
-            combined_content.append(f"From {source}: {best_content}")
-        
-        # Create cross-document analysis prompt
-        if len(all_sources) > 1:
-            prompt = f"""Based on content from multiple documents, answer the user's question by analyzing information across all sources.
+    # Embed the query for the cache lookup while the search runs; a cache hit discards the search
+    query_embedding, documents = await asyncio.gather(
+        asyncio.wait_for(asyncio.to_thread(embed_query, query), timeout=CACHE_EMBED_TIMEOUT),
+        asyncio.to_thread(search_documents, query),
+        return_exceptions=True
+    )
+    
+    # Serve paraphrases of earlier queries from the semantic cache
+    if isinstance(query_embedding, BaseException):
+        logger.error(f"Query cache error: {query_embedding!r}")
+        query_embedding = None
+    else:
+        cached_response = query_cache.lookup(query_embedding)
+        if cached_response:
+            logger.info("⚡ Semantic cache hit")
+            return cached_response
+    
+    if isinstance(documents, BaseException):
+        logger.error(f"Search error: {documents}")
+        documents = []
+    
+    if not documents:
+        return QueryResponse(
+            answer="No relevant information found",
+            explanation="I couldn't find any information in your uploaded documents that relates to your question. Please make sure you've uploaded PDF documents and try again.",
+            sources=None
+        )
+    
+    # Group documents by source for cross-document analysis
+    source_content = {}
+    for doc in documents:
+        content = doc.properties.get("content", "")
+        source = doc.properties.get("source", "unknown")
+        if source not in source_content:
+            source_content[source] = []
+        source_content[source].append(content)
+    
+    # Prepare content for analysis
+    all_sources = list(source_content.keys())
+    # Take the most relevant chunk from each document
+    combined_content = [
+        f"From {source}: {contents[0] if contents else ''}"
+        for source, contents in source_content.items()
+    ]
+    
+    # Create cross-document analysis prompt
+    if len(all_sources) > 1:
+        prompt = f"""Based on content from multiple documents, answer the user's question by analyzing information across all sources.
 
 Documents and Content:
 {chr(10).join(combined_content)}
 
-User Question: {request.query}
+User Question: {query}
 
 Please provide:
 1. A comprehensive answer that considers information from all relevant documents
 2. A clear explanation highlighting any differences, similarities, or complementary information across documents
-3. If there are conflicting information, mention it clearly
-
-Format your response exactly like this:
-Answer: [your comprehensive answer here]
-Explanation: [your detailed explanation here]
-Cross-Document Analysis: [analysis of how information relates across documents]
+3. A cross-document analysis of how the information relates across documents, clearly mentioning any conflicting information
 """
-        else:
-            # Single document analysis
-            prompt = f"""Based on this document content, answer the user's question in simple, clear language.
+    else:
+        # Single document analysis
+        prompt = f"""Based on this document content, answer the user's question in simple, clear language.
 
 Document Content: {combined_content[0]}
 
-User Question: {request.query}
+User Question: {query}
 
 Please provide:
 1. A direct, simple answer
 2. A clear explanation in everyday language
-
-Format your response exactly like this:
-Answer: [your direct answer here]
-Explanation: [your simple explanation here]
 """
 
+    try:
+        # Ask for JSON matching GeminiAnswer so no free-text parsing is needed
+        response = await asyncio.to_thread(
+            model.generate_content,
+            prompt,
+            generation_config=ANSWER_GENERATION_CONFIG
+        )
+        result = GeminiAnswer.model_validate_json(response.text)
+        
+        query_response = QueryResponse(
+            answer=result.answer,
+            explanation=result.explanation,
+            sources=all_sources,
+            cross_document_analysis=result.cross_document_analysis if len(all_sources) > 1 else None
+        )
+        if query_embedding is not None:
+            query_cache.store(query_embedding, query_response, cache_generation)
+        return query_response
+        
+    except Exception as e:
+        logger.error(f"Gemini error: {e}")
+        return QueryResponse(
+            answer="Found relevant information",
+            explanation=f"I found information in {len(all_sources)} document(s) that relates to your question.",
+            sources=all_sources
+        )
+
+# Cache pre-warming: sampled chunks per document and questions synthesized per chunk
+WARM_CACHE_SAMPLE_CHUNKS = 5
+WARM_CACHE_QUESTIONS_PER_CHUNK = 3
+
+async def warm_query_cache(chunks: List[str], source: str):
+    """Pre-populate the semantic cache with answers to likely questions about a document"""
+    # Answers computed after a later upload or delete clears the cache are discarded
+    cache_generation = query_cache.generation
+    
+    prompt = (
+        f"For each of the following excerpts from {source}, write {WARM_CACHE_QUESTIONS_PER_CHUNK} "
+        "natural questions a user might ask that the excerpt answers. "
+        "Return only the questions, one per line.\n\n"
+        + "\n\n".join(f"Excerpt {i}:\n{chunk}" for i, chunk in enumerate(chunks, 1))
+    )
+    try:
+        response = await asyncio.to_thread(model.generate_content, prompt)
+        lines = response.text.strip().split('\n')
+    except Exception as e:
+        logger.error(f"Question synthesis error for {source}: {e}")
+        return
+    
+    questions = [LIST_MARKER_RE.sub('', line).strip() for line in lines]
+    questions = [question for question in questions if question.endswith("?")]
+    
+    for question in questions:
         try:
-            response = model.generate_content(prompt)
-            response_text = response.text.strip()
-            
-            # Parse response
-            answer = "Unable to generate answer"
-            explanation = "There was an issue processing your question."
-            cross_analysis = None
-            
-            if "Answer:" in response_text:
-                parts = response_text.split("Answer:", 1)[1]
-                
-                if "Explanation:" in parts:
-                    answer_part, remaining = parts.split("Explanation:", 1)
-                    answer = answer_part.strip()
-                    
-                    if "Cross-Document Analysis:" in remaining:
-                        explanation_part, cross_part = remaining.split("Cross-Document Analysis:", 1)
-                        explanation = explanation_part.strip()
-                        cross_analysis = cross_part.strip()
-                    else:
-                        explanation = remaining.strip()
-                else:
-                    answer = parts.strip()
-            
-            # Fallback parsing
-            if answer == "Unable to generate answer":
-                lines = response_text.split('\n')
-                for line in lines:
-                    if line.startswith("Answer:"):
-                        answer = line.replace("Answer:", "").strip()
-                    elif line.startswith("Explanation:"):
-                        explanation = line.replace("Explanation:", "").strip()
-                    elif line.startswith("Cross-Document Analysis:"):
-                        cross_analysis = line.replace("Cross-Document Analysis:", "").strip()
-            
-            # Final fallback
-            if answer == "Unable to generate answer":
-                answer = f"Based on your document(s), here's what I found about your question."
-                explanation = f"Found relevant information in {len(all_sources)} document(s) that relates to your question about '{request.query}'."
-            
-            return QueryResponse(
-                answer=answer,
-                explanation=explanation,
-                sources=all_sources,
-                cross_document_analysis=cross_analysis if len(all_sources) > 1 else None
-            )
-            
+            await answer_query(question, cache_generation)
         except Exception as e:
-            logger.error(f"Gemini error: {e}")
-            return QueryResponse(
-                answer="Found relevant information",
-                explanation=f"I found information in {len(all_sources)} document(s) that relates to your question.",
-                sources=all_sources
-            )
-        
+            logger.error(f"Cache warmup error for '{question}': {e}")
+    
+    logger.info(f"✅ Warmed query cache with {len(questions)} questions from {source}")
+
+@app.post("/query", response_model=QueryResponse)
+async def query_documents(request: QueryRequest):
+    """Query documents with cross-document analysis"""
+    if not client:
+        raise HTTPException(status_code=500, detail="Database not available")
+    
+    try:
+        return await answer_query(request.query)
     except Exception as e:
         logger.error(f"Query error: {e}")
         raise HTTPException(status_code=500, detail=f"Query failed: {str(e)}")
@@ -440,16 +839,9 @@ async def clear_all_documents():
     try:
         # Delete and recreate collection
         client.collections.delete("PolicyDocument")
+        client.collections.create(**POLICY_COLLECTION_CONFIG)
         
-        client.collections.create(
-            name="PolicyDocument",
-            vectorizer_config=wvc.config.Configure.Vectorizer.text2vec_transformers(),
-            properties=[
-                wvc.config.Property(name="content", data_type=wvc.config.DataType.TEXT),
-                wvc.config.Property(name="source", data_type=wvc.config.DataType.TEXT)
-            ]
-        )
-        
+        query_cache.clear()
         logger.info("✅ All documents cleared")
         return {"message": "All documents cleared successfully"}
         
@@ -457,10 +849,35 @@ async def clear_all_documents():
         logger.error(f"Clear documents error: {e}")
         raise HTTPException(status_code=500, detail="Failed to clear documents")
 
+# Per-call timeout for the startup warmup; the server accepts no connections until it finishes
+# and run_system.py gives up after 15 s
+WARMUP_TIMEOUT = 3.0
+
+@app.on_event("startup")
+async def warmup_event():
+    """Warm up Gemini and the Weaviate connection so the first request isn't a cold start"""
+    request_options = {"timeout": WARMUP_TIMEOUT}
+    try:
+        await asyncio.to_thread(model.generate_content, "warmup", request_options=request_options)
+        await asyncio.to_thread(embed_query, "warmup", request_options)
+        await asyncio.to_thread(embed_documents, ["warmup"], request_options)
+    except Exception as e:
+        logger.warning(f"Gemini warmup failed: {e}")
+    
+    if client:
+        try:
+            # A read opens the gRPC channel and loads the collection; there is no vectorizer to warm
+            client.collections.get("PolicyDocument").query.fetch_objects(limit=1)
+            logger.info("✅ Warmup complete")
+        except Exception as e:
+            logger.warning(f"Weaviate warmup failed: {e}")
+
 @app.on_event("shutdown")
 async def shutdown_event():
     if client:
         client.close()
+    if _page_pool is not None:
+        _page_pool.shutdown(wait=False, cancel_futures=True)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,24 @@
+"""
+Structured output schema requested from Gemini for query answers.
+
+Kept apart from backend.py so it can be checked without connecting to Weaviate.
+"""
+
+from typing import Optional
+
+import google.generativeai as genai
+from pydantic import BaseModel
+
+
+class GeminiAnswer(BaseModel):
+    """Structured output requested from Gemini for a query"""
+    answer: str
+    explanation: str
+    # No default: the SDK rejects a schema field with one ("Unknown field for Schema: default")
+    cross_document_analysis: Optional[str]
+
+
+ANSWER_GENERATION_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=GeminiAnswer
+)
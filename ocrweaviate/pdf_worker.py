@@ -0,0 +1,15 @@
+"""
+Page text extraction for the backend's worker processes.
+
+Kept apart from backend.py so the worker pool only has to preload PyMuPDF.
+"""
+
+from typing import List
+
+import fitz  # PyMuPDF
+
+
+def extract_page_range(pdf_path: str, start: int, stop: int) -> List[str]:
+    """Extract text from pages [start, stop) of a PDF"""
+    with fitz.open(pdf_path) as pdf:
+        return [pdf.load_page(i).get_text("text") for i in range(start, stop)]
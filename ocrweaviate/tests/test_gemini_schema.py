@@ -0,0 +1,17 @@
+from google.generativeai import protos
+from google.generativeai.types import generation_types
+
+from gemini_schema import ANSWER_GENERATION_CONFIG, GeminiAnswer
+
+
+def test_answer_generation_config_builds():
+    # The SDK converts response_schema while building the request, before any network call
+    config = protos.GenerationConfig(generation_types.to_generation_config_dict(ANSWER_GENERATION_CONFIG))
+    assert set(config.response_schema.properties) == {"answer", "explanation", "cross_document_analysis"}
+
+
+def test_answer_parses_null_cross_document_analysis():
+    result = GeminiAnswer.model_validate_json(
+        '{"answer": "Yes", "explanation": "Covered.", "cross_document_analysis": null}'
+    )
+    assert result.cross_document_analysis is None